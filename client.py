@@ -1,17 +1,49 @@
 """
 Klient API KSeF - uwierzytelnianie i pobieranie faktur
 """
+import math
+import orjson
+import random
 import requests
 import time
-from typing import Optional, Dict, Any
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, Any, Iterator
 from crypto import Crypto
 
 
+class RequestRejected(Exception):
+    """Odrzucenie żądania przez KSeF (np. dane zaszyfrowane nieaktualnym kluczem)"""
+
+
+def poll_delays(initial: float = 0.2, maximum: float = 5.0) -> Iterator[float]:
+    """
+    Generuje kolejne opóźnienia odpytywania (wykładniczo, z losowym rozrzutem)
+    
+    Args:
+        initial: Pierwsze opóźnienie w sekundach
+        maximum: Maksymalne opóźnienie w sekundach
+    """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 1.7 + random.uniform(0, 0.1), maximum)
+
+
 class KSeFClient:
     """Klient systemu KSeF (środowisko produkcyjne)"""
     
     BASE_URL = "https://api.ksef.mf.gov.pl/v2"
     
+    # Liczba ponowień żądania po odpowiedzi 429 (limit zapytań)
+    MAX_RATE_LIMIT_RETRIES = 5
+    
+    # Maksymalny czas oczekiwania przed ponowieniem (sekundy)
+    MAX_RETRY_DELAY = 30.0
+    
+    # Rozmiar puli połączeń - części paczek pobierane są równolegle dla
+    # wszystkich typów podmiotów, a każde zwolnione połączenie ma być użyte ponownie
+    CONNECTION_POOL_SIZE = 32
+    
     def __init__(self, ksef_token: str, context_nip: str):
         """
         Inicjalizacja klienta
@@ -22,13 +54,17 @@ class KSeFClient:
         """
         self.ksef_token = ksef_token
         self.context_nip = context_nip
-        self.crypto = Crypto()
         self.access_token: Optional[str] = None
         self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=self.CONNECTION_POOL_SIZE,
+            pool_maxsize=self.CONNECTION_POOL_SIZE
+        ))
         self.session.headers.update({
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         })
+        self.crypto = Crypto(session=self.session)
     
     def authenticate(self) -> bool:
         """
@@ -37,6 +73,22 @@ class KSeFClient:
         Returns:
             True jeśli sukces
         """
+        try:
+            return self._authenticate()
+        except RequestRejected as rejection:
+            # Odrzucenie może wynikać z nieaktualnego certyfikatu z pamięci
+            # podręcznej - pobierz klucze z API i spróbuj jeszcze raz
+            if not self.crypto.keys_from_cache:
+                raise
+            try:
+                self.crypto.refresh_public_keys()
+            except Exception:
+                raise rejection
+        
+        return self._authenticate()
+    
+    def _authenticate(self) -> bool:
+        """Wykonuje jedną próbę uwierzytelnienia"""
         # Krok 1: Pobierz challenge
         challenge_data = self._get_challenge()
         challenge = challenge_data['challenge']
@@ -58,12 +110,49 @@ class KSeFClient:
         
         return True
     
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Wysyła żądanie do API, ponawiając je po przekroczeniu limitu zapytań"""
+        delays = poll_delays(initial=1.0, maximum=self.MAX_RETRY_DELAY)
+        response = self.session.request(method, url, **kwargs)
+        for _ in range(self.MAX_RATE_LIMIT_RETRIES):
+            if response.status_code != 429:
+                break
+            retry_after = self._retry_after(response)
+            if retry_after is None:
+                retry_after = next(delays)
+            time.sleep(min(retry_after, self.MAX_RETRY_DELAY))
+            response = self.session.request(method, url, **kwargs)
+        
+        response.raise_for_status()
+        return response
+    
+    def _post_encrypted(self, url: str, **kwargs) -> requests.Response:
+        """Wysyła żądanie z danymi zaszyfrowanymi kluczem publicznym KSeF"""
+        try:
+            return self._request('POST', url, **kwargs)
+        except requests.HTTPError as e:
+            # Błąd klienta (poza limitem zapytań) oznacza odrzucenie danych
+            status_code = e.response.status_code if e.response is not None else None
+            if status_code is not None and 400 <= status_code < 500 and status_code != 429:
+                raise RequestRejected(str(e)) from e
+            raise
+    
+    @staticmethod
+    def _retry_after(response: requests.Response) -> Optional[float]:
+        """Odczytuje nagłówek Retry-After (w sekundach, tylko poprawne wartości)"""
+        try:
+            retry_after = float(response.headers.get('Retry-After', ''))
+        except ValueError:
+            return None
+        if not math.isfinite(retry_after):
+            return None
+        return max(retry_after, 0.0)
+    
     def _get_challenge(self) -> Dict[str, Any]:
         """Pobiera auth challenge"""
         url = f"{self.BASE_URL}/auth/challenge"
-        response = self.session.post(url)
-        response.raise_for_status()
-        return response.json()
+        response = self._request('POST', url)
+        return orjson.loads(response.content)
     
     def _submit_auth(self, encrypted_token: str, challenge: str) -> Dict[str, Any]:
         """Wysyła żądanie uwierzytelnienia"""
@@ -78,20 +167,19 @@ class KSeFClient:
             "encryptedToken": encrypted_token
         }
         
-        response = self.session.post(url, json=payload)
-        response.raise_for_status()
-        return response.json()
+        response = self._post_encrypted(url, data=orjson.dumps(payload))
+        return orjson.loads(response.content)
     
     def _wait_for_auth_completion(self, reference_number: str, auth_token: str, max_attempts: int = 10):
         """Czeka na zakończenie uwierzytelniania"""
         url = f"{self.BASE_URL}/auth/{reference_number}"
         headers = {'Authorization': f'Bearer {auth_token}'}
         
+        delays = poll_delays()
         for _ in range(max_attempts):
-            response = self.session.get(url, headers=headers)
-            response.raise_for_status()
+            response = self._request('GET', url, headers=headers)
             
-            data = response.json()
+            data = orjson.loads(response.content)
             status_code = data.get('status', {}).get('code')
             
             # API zwraca kod 200 dla sukcesu
@@ -99,9 +187,9 @@ class KSeFClient:
                 return
             elif status_code >= 400:
                 description = data.get('status', {}).get('description', 'Unknown error')
-                raise Exception(f"Uwierzytelnianie nie powiodło się: {description}")
+                raise RequestRejected(f"Uwierzytelnianie nie powiodło się: {description}")
             
-            time.sleep(2)
+            time.sleep(next(delays))
         
         raise Exception("Timeout podczas oczekiwania na uwierzytelnienie")
     
@@ -110,10 +198,9 @@ class KSeFClient:
         url = f"{self.BASE_URL}/auth/token/redeem"
         headers = {'Authorization': f'Bearer {auth_token}'}
         
-        response = self.session.post(url, headers=headers)
-        response.raise_for_status()
+        response = self._request('POST', url, headers=headers)
         
-        data = response.json()
+        data = orjson.loads(response.content)
         self.access_token = data['accessToken']['token']
     
     def export_invoices(self, 
@@ -181,11 +268,10 @@ class KSeFClient:
             "encryption": encryption_info
         }
         
-        response = self.session.post(url, json=payload, headers=headers)
-        response.raise_for_status()
+        response = self._post_encrypted(url, data=orjson.dumps(payload), headers=headers)
         
         # Przechowaj klucz i IV dla późniejszego deszyfrowania
-        data = response.json()
+        data = orjson.loads(response.content)
         data['_encryption_key'] = encryption_key
         data['_encryption_iv'] = encryption_iv
         
@@ -208,23 +294,22 @@ class KSeFClient:
         
         headers = {'Authorization': f'Bearer {self.access_token}'}
         
-        response = self.session.get(url, headers=headers)
-        response.raise_for_status()
+        response = self._request('GET', url, headers=headers)
         
-        return response.json()
+        return orjson.loads(response.content)
     
-    def download_package_part(self, part_url: str) -> bytes:
+    def stream_package_part(self, part_url: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
         """
-        Pobiera część paczki eksportu
+        Pobiera strumieniowo część paczki eksportu
         
         Args:
             part_url: URL części paczki (signed URL z Azure Storage)
+            chunk_size: Rozmiar pojedynczego fragmentu w bajtach
             
         Returns:
-            Surowe bajty zaszyfrowanej części
+            Iterator kolejnych fragmentów zaszyfrowanej części
         """
         # Signed URL nie wymaga tokena Authorization
-        response = self.session.get(part_url)
-        response.raise_for_status()
-        
-        return response.content
+        with self.session.get(part_url, stream=True) as response:
+            response.raise_for_status()
+            yield from response.iter_content(chunk_size=chunk_size)
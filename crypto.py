@@ -2,29 +2,85 @@
 Moduł kryptograficzny do szyfrowania tokenów KSeF oraz deszyfrowania faktur
 """
 import base64
+import functools
+import json
+import os
+import threading
+import time
 import requests
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryFile
+from typing import Optional, List, Dict, Any, Iterable, BinaryIO
 from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives import padding as sym_padding
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from cryptography import x509
 
 
+# Lokalna kopia certyfikatów kluczy publicznych - MF zmienia je rzadko
+_CACHE_PATH = Path.home() / ".cache" / "ksef-cli" / "pubkeys.json"
+_CACHE_TTL = 24 * 3600
+
+
+@functools.lru_cache(maxsize=8)
+def _load_public_key_cached(certificate_b64: str):
+    """Ładuje klucz publiczny z certyfikatu Base64 (wynik zapamiętywany w procesie)"""
+    cert_der = base64.b64decode(certificate_b64)
+    cert = x509.load_der_x509_certificate(cert_der, default_backend())
+    return cert.public_key()
+
+
 class Crypto:
     """Obsługa operacji kryptograficznych dla KSeF"""
     
-    def __init__(self):
-        """Inicjalizacja - pobiera klucze publiczne z API produkcyjnego"""
+    def __init__(self, session: Optional[requests.Session] = None):
+        """
+        Inicjalizacja - pobiera klucze publiczne z API produkcyjnego
+        
+        Args:
+            session: Sesja HTTP do ponownego użycia połączenia (opcjonalne)
+        """
+        self._session = session or requests.Session()
+        self.keys_from_cache = False
+        self._refresh_lock = threading.Lock()
         self._fetch_public_keys()
     
-    def _fetch_public_keys(self):
-        """Pobiera klucze publiczne z API KSeF (produkcja)"""
+    def refresh_public_keys(self):
+        """Pobiera klucze publiczne z API, jeśli bieżące pochodzą z pamięci podręcznej"""
+        # Eksporty działają w wielu wątkach - klucze pobiera tylko pierwszy z nich
+        with self._refresh_lock:
+            if self.keys_from_cache:
+                self._fetch_public_keys(use_cache=False)
+    
+    def _fetch_public_keys(self, use_cache: bool = True):
+        """Pobiera klucze publiczne z pamięci podręcznej lub z API KSeF (produkcja)"""
+        certificates = self._load_cached_certificates() if use_cache else None
+        if certificates is not None:
+            try:
+                self._load_certificates(certificates)
+                self.keys_from_cache = True
+                return
+            except Exception:
+                # Uszkodzona lub nieaktualna kopia - pobierz certyfikaty ponownie z API
+                pass
+        
         url = "https://api.ksef.mf.gov.pl/v2/security/public-key-certificates"
         
-        response = requests.get(url)
+        response = self._session.get(url)
         response.raise_for_status()
         
         certificates = response.json()
+        self._load_certificates(certificates)
+        self.keys_from_cache = False
+        self._save_cached_certificates(certificates)
+    
+    def _load_certificates(self, certificates: List[Dict[str, Any]]):
+        """Ustawia klucze publiczne na podstawie listy certyfikatów z API"""
+        token_public_key = None
+        symmetric_key_public_key = None
         
         # Znajdź certyfikaty do szyfrowania
         for cert_info in certificates:
@@ -32,22 +88,62 @@ class Crypto:
             certificate_b64 = cert_info['certificate']
             
             if 'KsefTokenEncryption' in usage:
-                self.token_public_key = self._load_public_key(certificate_b64)
+                token_public_key = self._load_public_key(certificate_b64)
             
             if 'SymmetricKeyEncryption' in usage:
-                self.symmetric_key_public_key = self._load_public_key(certificate_b64)
+                symmetric_key_public_key = self._load_public_key(certificate_b64)
         
-        if not hasattr(self, 'token_public_key'):
+        if token_public_key is None:
             raise Exception("Nie znaleziono certyfikatu do szyfrowania tokenów KSeF")
         
-        if not hasattr(self, 'symmetric_key_public_key'):
+        if symmetric_key_public_key is None:
             raise Exception("Nie znaleziono certyfikatu do szyfrowania kluczy symetrycznych")
+        
+        self.token_public_key = token_public_key
+        self.symmetric_key_public_key = symmetric_key_public_key
+    
+    def _load_cached_certificates(self) -> Optional[List[Dict[str, Any]]]:
+        """Zwraca certyfikaty z pamięci podręcznej, jeśli są świeże"""
+        try:
+            if time.time() - _CACHE_PATH.stat().st_mtime >= _CACHE_TTL:
+                return None
+            with open(_CACHE_PATH, 'r') as f:
+                certificates = json.load(f)
+            
+            # Pomiń certyfikaty, których ważność już minęła
+            return [cert_info for cert_info in certificates if not self._is_expired(cert_info)]
+        except (OSError, ValueError, TypeError, AttributeError):
+            return None
+    
+    @staticmethod
+    def _is_expired(cert_info: Dict[str, Any]) -> bool:
+        """Sprawdza, czy minęła data validTo certyfikatu (nieczytelna data = nieważny)"""
+        valid_to = cert_info.get('validTo')
+        if not valid_to:
+            return False
+        try:
+            expires_at = datetime.fromisoformat(valid_to.replace('Z', '+00:00'))
+        except (AttributeError, ValueError):
+            return True
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return expires_at <= datetime.now(timezone.utc)
+    
+    def _save_cached_certificates(self, certificates: List[Dict[str, Any]]):
+        """Zapisuje certyfikaty do pamięci podręcznej (atomowo)"""
+        try:
+            _CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = _CACHE_PATH.with_suffix('.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(certificates, f)
+            os.replace(tmp_path, _CACHE_PATH)
+        except OSError:
+            # Brak pamięci podręcznej nie blokuje działania narzędzia
+            pass
     
     def _load_public_key(self, certificate_b64: str):
         """Ładuje klucz publiczny z certyfikatu w formacie Base64"""
-        cert_der = base64.b64decode(certificate_b64)
-        cert = x509.load_der_x509_certificate(cert_der, default_backend())
-        return cert.public_key()
+        return _load_public_key_cached(certificate_b64)
     
     def encrypt_token(self, ksef_token: str, timestamp_ms: int) -> str:
         """
@@ -74,26 +170,35 @@ class Crypto:
         
         return base64.b64encode(encrypted).decode('utf-8')
     
-    def decrypt_aes(self, encrypted_data: bytes, key: bytes, iv: bytes) -> bytes:
+    def decrypt_aes_stream(self, chunks: Iterable[bytes], key: bytes, iv: bytes) -> BinaryIO:
         """
-        Deszyfruje dane AES-256-CBC
+        Deszyfruje strumieniowo dane AES-256-CBC do pliku tymczasowego
         
         Args:
-            encrypted_data: Zaszyfrowane dane
+            chunks: Kolejne fragmenty zaszyfrowanych danych
             key: Klucz AES (32 bajty)
             iv: Wektor inicjalizacji (16 bajtów)
             
         Returns:
-            Odszyfrowane dane
+            Plik tymczasowy z odszyfrowanymi danymi, ustawiony na początek
         """
         cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
         decryptor = cipher.decryptor()
+        unpadder = sym_padding.PKCS7(algorithms.AES.block_size).unpadder()
         
-        decrypted = decryptor.update(encrypted_data) + decryptor.finalize()
+        # Prawdziwy plik - ZipFile wymaga seekable(), którego SpooledTemporaryFile
+        # nie ma przed Pythonem 3.11
+        output = TemporaryFile()
+        try:
+            for chunk in chunks:
+                output.write(unpadder.update(decryptor.update(chunk)))
+            output.write(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+        except BaseException:
+            output.close()
+            raise
         
-        # Usuń padding PKCS7
-        padding_length = decrypted[-1]
-        return decrypted[:-padding_length]
+        output.seek(0)
+        return output
     
     def encrypt_symmetric_key(self, symmetric_key: bytes) -> str:
         """
@@ -6,17 +6,20 @@ Zapisuje faktury w folderze faktury/ i zwraca JSON z podsumowaniem
 import os
 import sys
 import json
-import time
 import argparse
+import queue
+import shutil
+import threading
 import zipfile
-from io import BytesIO
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import closing
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Set, Optional
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import orjson
 from dotenv import load_dotenv
 
-from client import KSeFClient
-from crypto import Crypto
+from client import KSeFClient, RequestRejected, poll_delays
 
 
 # Ścieżki
@@ -24,6 +27,9 @@ BASE_DIR = Path(__file__).parent
 FAKTURY_DIR = BASE_DIR / "faktury"
 STATE_FILE = BASE_DIR / ".ksef_state.json"
 
+# Rozmiar bufora przy zapisie faktur z paczki
+COPY_BUFFER_SIZE = 64 * 1024
+
 
 class InvoiceFetcher:
     """Klasa obsługująca przyrostowe pobieranie faktur"""
@@ -31,10 +37,16 @@ class InvoiceFetcher:
     # Typy podmiotów do pobierania
     SUBJECT_TYPES = ['Subject1', 'Subject2', 'Subject3']
     
+    # Maksymalna liczba równolegle pobieranych części jednej paczki
+    MAX_PART_DOWNLOADS = 8
+    
+    # Maksymalna liczba buforowanych fragmentów (64 KiB) na pobieraną część
+    MAX_QUEUED_CHUNKS = 16
+    
     def __init__(self, client: KSeFClient, output_format: str = 'json'):
         self.client = client
         self.output_format = output_format
-        self.crypto = Crypto()
+        self.crypto = client.crypto
         
         # Twórz katalog na faktury jeśli nie istnieje
         FAKTURY_DIR.mkdir(exist_ok=True)
@@ -47,6 +59,12 @@ class InvoiceFetcher:
         
         # Nowe faktury w tym przebiegu
         self.new_invoices: List[Dict] = []
+        
+        # Typy podmiotów przetwarzane są równolegle - chroni stan współdzielony
+        self._lock = threading.Lock()
+        
+        # Ustawiany po pierwszym błędzie - pozostałe typy podmiotów przerywają pracę
+        self._stop = threading.Event()
     
     def _load_state(self) -> Dict:
         """Ładuje stan ostatniego pobierania"""
@@ -56,18 +74,34 @@ class InvoiceFetcher:
         return {}
     
     def _save_state(self):
-        """Zapisuje stan ostatniego pobierania"""
-        with open(STATE_FILE, 'w') as f:
+        """Zapisuje stan ostatniego pobierania (atomowo)"""
+        # Zapis do pliku tymczasowego i podmiana - przerwany zapis nie psuje stanu
+        tmp_file = STATE_FILE.with_suffix('.json.tmp')
+        with open(tmp_file, 'w') as f:
             json.dump(self.state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, STATE_FILE)
     
     def fetch_invoices(self):
         """Główna metoda pobierająca faktury"""
         # Uwierzytelnij się
         self.client.authenticate()
         
-        # Pobierz faktury dla każdego typu podmiotu
-        for subject_type in self.SUBJECT_TYPES:
-            self._fetch_for_subject_type(subject_type)
+        # Pobierz faktury dla wszystkich typów podmiotów równolegle
+        with ThreadPoolExecutor(max_workers=len(self.SUBJECT_TYPES)) as executor:
+            futures = [
+                executor.submit(self._fetch_for_subject_type, subject_type)
+                for subject_type in self.SUBJECT_TYPES
+            ]
+            try:
+                # Pierwszy błąd (lub Ctrl-C) zatrzymuje pozostałe typy podmiotów
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+            except BaseException:
+                self._stop.set()
+                raise
         
         # Zapisz stan
         self._save_state()
@@ -86,18 +120,26 @@ class InvoiceFetcher:
             now = datetime.now(timezone.utc)
             date_from = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
         
-        # Inicjuj eksport (bez date_to - system sam określi zakres)
-        export_response = self.client.export_invoices(
-            subject_type=subject_type,
-            date_from=date_from
-        )
+        # Odczytaj przed eksportem - inny wątek może w międzyczasie odświeżyć klucze
+        keys_from_cache = self.crypto.keys_from_cache
+        try:
+            export_response, status = self._run_export(subject_type, date_from)
+        except RequestRejected as rejection:
+            # Klucz AES mógł zostać zaszyfrowany nieaktualnym certyfikatem z pamięci
+            # podręcznej - pobierz klucze z API i ponów eksport
+            if not keys_from_cache:
+                raise
+            try:
+                self.crypto.refresh_public_keys()
+            except Exception:
+                raise rejection
+            export_response, status = self._run_export(subject_type, date_from)
         
-        reference_number = export_response['referenceNumber']
         encryption_key = export_response['_encryption_key']
         encryption_iv = export_response['_encryption_iv']
         
-        # Poczekaj na zakończenie eksportu
-        status = self._wait_for_export_completion(reference_number)
+        if self._stop.is_set():
+            raise Exception("Przerwano pobieranie faktur")
         
         if status.get('package'):
             # Pobierz i przetwórz paczkę
@@ -107,8 +149,22 @@ class InvoiceFetcher:
             # Aktualizuj punkt kontynuacji
             self._update_continuation_point(subject_type, package)
     
+    def _run_export(self, subject_type: str, date_from: str) -> Tuple[Dict, Dict]:
+        """Inicjuje eksport i czeka na jego zakończenie"""
+        # Inicjuj eksport (bez date_to - system sam określi zakres)
+        export_response = self.client.export_invoices(
+            subject_type=subject_type,
+            date_from=date_from
+        )
+        
+        # Poczekaj na zakończenie eksportu
+        status = self._wait_for_export_completion(export_response['referenceNumber'])
+        
+        return export_response, status
+    
     def _wait_for_export_completion(self, reference_number: str, max_attempts: int = 60) -> Dict:
         """Czeka na zakończenie eksportu"""
+        delays = poll_delays()
         for _ in range(max_attempts):
             status = self.client.get_export_status(reference_number)
             
@@ -119,9 +175,10 @@ class InvoiceFetcher:
                 return status
             elif status_code >= 400:
                 description = status.get('status', {}).get('description', 'Unknown error')
-                raise Exception(f"Eksport nie powiódł się: {description}")
+                raise RequestRejected(f"Eksport nie powiódł się: {description}")
             
-            time.sleep(5)
+            if self._stop.wait(next(delays)):
+                raise Exception("Przerwano oczekiwanie na eksport")
         
         raise Exception("Timeout podczas oczekiwania na eksport")
     
@@ -132,73 +189,120 @@ class InvoiceFetcher:
         if not parts:
             return
         
-        # Pobierz i połącz części
-        encrypted_data = BytesIO()
-        for part in parts:
-            part_url = part['url']
-            part_data = self.client.download_package_part(part_url)
-            encrypted_data.write(part_data)
-        
-        # Odszyfruj
-        encrypted_data.seek(0)
-        decrypted_data = self.crypto.decrypt_aes(
-            encrypted_data.read(),
-            encryption_key,
-            encryption_iv
-        )
+        # Odszyfruj części w trakcie pobierania
+        part_urls = [part['url'] for part in parts]
+        with closing(self._iter_package_chunks(part_urls)) as chunks:
+            decrypted_data = self.crypto.decrypt_aes_stream(
+                chunks,
+                encryption_key,
+                encryption_iv
+            )
         
         # Rozpakuj ZIP
-        with zipfile.ZipFile(BytesIO(decrypted_data)) as zf:
-            # Odczytaj metadane
-            metadata = None
-            if '_metadata.json' in zf.namelist():
-                with zf.open('_metadata.json') as f:
-                    metadata = json.load(f)
+        with decrypted_data, zipfile.ZipFile(decrypted_data) as zf:
+            filenames = zf.namelist()
+            
+            # Odczytaj metadane i zbuduj indeks: nazwa pliku -> numer KSeF
+            ksef_numbers: Dict[str, str] = {}
+            if '_metadata.json' in filenames:
+                metadata = orjson.loads(zf.read('_metadata.json'))
+                for inv in (metadata or {}).get('invoices', []):
+                    ksef_numbers[f"{inv['ksefNumber']}.xml"] = inv['ksefNumber']
             
             # Przetwórz faktury
-            for filename in zf.namelist():
-                if filename.endswith('.xml'):
-                    self._save_invoice(zf, filename, metadata)
+            for filename in filenames:
+                if not filename.endswith('.xml'):
+                    continue
+                
+                # Nie zapisuj faktur, których wynik i tak nie zostanie zgłoszony
+                if self._stop.is_set():
+                    raise Exception("Przerwano zapisywanie faktur")
+                
+                # Jeśli nie ma w metadanych, wyciągnij numer z nazwy pliku
+                ksef_number = ksef_numbers.get(filename) or filename.replace('.xml', '')
+                self._save_invoice(zf, filename, ksef_number)
     
-    def _save_invoice(self, zf: zipfile.ZipFile, filename: str, metadata: Optional[Dict]):
-        """Zapisuje fakturę do pliku"""
-        # Wyciągnij numer KSeF z metadanych
-        ksef_number = None
-        if metadata and 'invoices' in metadata:
-            # Znajdź fakturę po nazwie pliku
-            for inv in metadata['invoices']:
-                inv_filename = f"{inv['ksefNumber']}.xml"
-                if inv_filename == filename:
-                    ksef_number = inv['ksefNumber']
-                    break
-        
-        # Jeśli nie ma w metadanych, spróbuj wyciągnąć z nazwy pliku
-        if not ksef_number:
-            ksef_number = filename.replace('.xml', '')
-        
-        # Sprawdź deduplikację
-        if ksef_number in self.downloaded_invoices:
-            return
+    def _iter_package_chunks(self, part_urls: List[str]) -> Iterator[bytes]:
+        """Pobiera części równolegle i zwraca ich fragmenty w oryginalnej kolejności"""
+        # Ograniczone kolejki - pobieranie nie wyprzedza deszyfrowania o więcej niż
+        # MAX_QUEUED_CHUNKS fragmentów na część
+        chunk_queues = [queue.Queue(maxsize=self.MAX_QUEUED_CHUNKS) for _ in part_urls]
+        cancelled = threading.Event()
         
-        # Sprawdź czy już istnieje na dysku
-        invoice_path = FAKTURY_DIR / filename
-        if invoice_path.exists():
-            self.downloaded_invoices.add(ksef_number)
-            return
+        def put(chunk_queue: queue.Queue, chunk: Optional[bytes]) -> bool:
+            # Czekaj na miejsce w kolejce, chyba że odbiorca przerwał przetwarzanie
+            while not cancelled.is_set():
+                try:
+                    chunk_queue.put(chunk, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def download(part_url: str, chunk_queue: queue.Queue):
+            try:
+                # Części czekające w puli nie startują po przerwaniu przetwarzania
+                if cancelled.is_set():
+                    return
+                for chunk in self.client.stream_package_part(part_url):
+                    if not put(chunk_queue, chunk):
+                        return
+            finally:
+                # Koniec części (również w razie błędu)
+                put(chunk_queue, None)
         
-        # Zapisz fakturę
-        with zf.open(filename) as f:
-            invoice_content = f.read()
+        with ThreadPoolExecutor(max_workers=min(len(part_urls), self.MAX_PART_DOWNLOADS)) as executor:
+            futures = [
+                executor.submit(download, part_url, chunk_queue)
+                for part_url, chunk_queue in zip(part_urls, chunk_queues)
+            ]
+            try:
+                for future, chunk_queue in zip(futures, chunk_queues):
+                    for chunk in iter(chunk_queue.get, None):
+                        if self._stop.is_set():
+                            raise Exception("Przerwano pobieranie paczki")
+                        yield chunk
+                    # Zgłoś ewentualny błąd pobierania tej części
+                    future.result()
+            finally:
+                # Zwolnij wątki pobierające, jeśli przetwarzanie zostało przerwane
+                cancelled.set()
+    
+    def _save_invoice(self, zf: zipfile.ZipFile, filename: str, ksef_number: str):
+        """Zapisuje fakturę do pliku"""
+        with self._lock:
+            # Sprawdź deduplikację
+            if ksef_number in self.downloaded_invoices:
+                return
+            
+            # Sprawdź czy już istnieje na dysku
+            invoice_path = FAKTURY_DIR / filename
+            if invoice_path.exists():
+                self.downloaded_invoices.add(ksef_number)
+                return
+            
+            # Zarezerwuj numer, aby inny typ podmiotu nie zapisał tej samej faktury
+            self.downloaded_invoices.add(ksef_number)
         
-        with open(invoice_path, 'wb') as f:
-            f.write(invoice_content)
+        # Zapisz fakturę strumieniowo do pliku tymczasowego i podmień dopiero po
+        # sprawdzeniu CRC - uszkodzony wpis ZIP nie zostawi pustej faktury na dysku
+        tmp_path = invoice_path.with_suffix('.xml.tmp')
+        try:
+            with zf.open(filename) as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            os.replace(tmp_path, invoice_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            with self._lock:
+                self.downloaded_invoices.discard(ksef_number)
+            raise
         
         # Dodaj do listy nowych
-        self.downloaded_invoices.add(ksef_number)
-        self.new_invoices.append({
-            'ksefNumber': ksef_number,
-            'filename': filename
-        })
+        with self._lock:
+            self.new_invoices.append({
+                'ksefNumber': ksef_number,
+                'filename': filename
+            })
     
     def _update_continuation_point(self, subject_type: str, package: Dict):
         """Aktualizuje punkt kontynuacji dla typu podmiotu"""
@@ -223,7 +327,7 @@ class InvoiceFetcher:
         }
         
         if self.output_format == 'json':
-            return json.dumps(result, indent=2, ensure_ascii=False)
+            return orjson.dumps(result, option=orjson.OPT_INDENT_2).decode('utf-8')
         else:
             # Format tekstowy
             lines = [